@@ -1,5 +1,6 @@
 import os
-from typing import Dict, List
+import copy
+from typing import Any, Dict, List
 import streamlit as st
 import sys
 import logging
@@ -14,18 +15,69 @@ from fiche_cuisine_app import menu_parser
 from fiche_cuisine_app import matcher
 from fiche_cuisine_app import pdf_gen
 from fiche_cuisine_app import logging_utils
+from fiche_cuisine_app import state_store
 
 st.set_page_config(page_title="Fiche Cuisine", page_icon="🍽️", layout="wide")
 
-if "lexicon" not in st.session_state:
-    st.session_state.lexicon = {k: [] for k in menu_parser.SECTION_KEYWORDS.keys()}
-if "reservations" not in st.session_state:
-    st.session_state.reservations: List[Dict] = []
+STORE = state_store.get_store()
+# Widget keys to reset when a shared document is reloaded from the store
+SHARED_WIDGETS = {
+    "lexicon": ("lex_",),
+    "reservations": ("r_", "it_name_", "it_qty_"),
+}
+
+
+def _sync_shared(name: str, default: Any) -> None:
+    """Load the shared document on first run or after a conflict/remote change.
+
+    Widget edits only reach `st.session_state[name]` while the page renders, so
+    remote changes are detected in `_save_shared` once local edits are known.
+    """
+    if st.session_state.get(f"{name}_version") is not None:
+        return
+    value, version = state_store.load_document(STORE, name, default)
+    st.session_state[name] = value
+    st.session_state[f"{name}_version"] = version
+    st.session_state[f"{name}_saved"] = copy.deepcopy(value)
+    for k in list(st.session_state.keys()):
+        if isinstance(k, str) and k.startswith(SHARED_WIDGETS[name]):
+            del st.session_state[k]
+
+
+def _save_shared(name: str) -> None:
+    """Write local edits back, or pick up changes made by another replica.
+
+    Local edits based on an outdated version raise VersionConflict: the user is
+    warned and the shared version is reloaded instead of being overwritten.
+    """
+    value = st.session_state[name]
+    if value == st.session_state.get(f"{name}_saved"):
+        if state_store.document_version(STORE, name) != st.session_state.get(f"{name}_version"):
+            logging.info(f"UI: '{name}' changed on another replica; reloading")
+            st.session_state[f"{name}_version"] = None
+            st.rerun()
+        return
+    try:
+        st.session_state[f"{name}_version"] = state_store.save_document(
+            STORE, name, value, st.session_state.get(f"{name}_version", 0))
+        st.session_state[f"{name}_saved"] = copy.deepcopy(value)
+    except state_store.VersionConflict as e:
+        logging.warning(f"UI: concurrent edit on '{name}' ({e}); reloading shared version")
+        st.session_state[f"{name}_version"] = None
+        st.session_state.state_conflict = name
+        st.rerun()
+
+
+_sync_shared("lexicon", {k: [] for k in menu_parser.SECTION_KEYWORDS.keys()})
+_sync_shared("reservations", [])
 if "log_level" not in st.session_state:
     st.session_state.log_level = "INFO"
 
 st.title("Fiche Cuisine (FR/NL)")
 
+if st.session_state.pop("state_conflict", None):
+    st.warning("Modifié en parallèle par un autre poste: la dernière version partagée a été rechargée.")
+
 with st.expander("Configuration Tesseract", expanded=False):
     tess = st.text_input("Tesseract path (si non dans PATH)", value=os.environ.get("TESSERACT_CMD", ""))
     if st.button("Appliquer"):
@@ -102,6 +154,9 @@ with menu_tab:
             lex_f = menu_parser.build_lexicon_from_text(text, only_formules=True)
             combined = menu_parser.merge_lexicons(combined, lex_f)
         st.session_state.lexicon = combined
+        _save_shared("lexicon")
+        for sec in combined.keys():
+            st.session_state.pop(f"lex_{sec}", None)
         st.success("Lexique mis à jour.")
         logging.info("UI: Lexicon updated and stored in session")
     st.write("Lexique actuel (éditable):")
@@ -111,6 +166,7 @@ with menu_tab:
         text_val = "\n".join(values)
         new_text = st.text_area(f"{sec}", value=text_val, height=120, key=f"lex_{sec}")
         st.session_state.lexicon[sec] = [v.strip() for v in new_text.splitlines() if v.strip()]
+    _save_shared("lexicon")
 
 with notes_tab:
     st.subheader("Importer vos captures d'écran de réservations")
@@ -120,7 +176,7 @@ with notes_tab:
         logging.info(f"UI: Analyzing {len(imgs)} uploaded image(s)")
         for up in imgs:
             raw = up.getvalue()
-            full_text, notes = ocr.notes_from_image_bytes(raw)
+            full_text, notes = state_store.cached_ocr(STORE, raw, ocr.notes_from_image_bytes)
             # Create one reservation per note block
             if not notes:
                 notes = [""]
@@ -133,6 +189,10 @@ with notes_tab:
                     "note": note,
                     "items": items,
                 })
+        _save_shared("reservations")
+        for k in list(st.session_state.keys()):
+            if isinstance(k, str) and k.startswith(SHARED_WIDGETS["reservations"]):
+                del st.session_state[k]
         logging.info(f"UI: Detected {len(st.session_state.reservations)} reservation block(s)")
         st.success(f"{len(st.session_state.reservations)} réservation(s) détectée(s).")
 
@@ -165,6 +225,7 @@ with notes_tab:
             if st.button("+ Ajouter un plat", key=f"add_item_{i}"):
                 res["items"].append({"section": "", "name": "", "qty": 1, "score": 0, "original": ""})
                 logging.debug(f"UI: Added empty item to reservation {i}")
+    _save_shared("reservations")
 
 with export_tab:
     st.subheader("Générer la fiche cuisine PDF")
@@ -0,0 +1,345 @@
+from __future__ import annotations
+import os
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import logging
+from abc import ABC, abstractmethod
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Tuple
+import redis
+from redis.exceptions import WatchError
+
+logger = logging.getLogger(__name__)
+
+# Documents shared between replicas are stored under "<namespace>:<name>".
+# Version 0 means "absent"; every successful write bumps the version by one.
+
+
+class VersionConflict(Exception):
+    """Raised when a write is based on a version that is no longer current."""
+
+    def __init__(self, key: str, expected: int, current: int):
+        super().__init__(f"{key}: expected version {expected}, found {current}")
+        self.key = key
+        self.expected = expected
+        self.current = current
+
+
+class StateStore(ABC):
+    """Versioned key/value store holding JSON-serializable values."""
+
+    @abstractmethod
+    def get(self, key: str) -> Tuple[Optional[Any], int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_version(self, key: str) -> int:
+        """Return the current version of `key` (0 if absent) without loading its value."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def put(self, key: str, value: Any, expected_version: Optional[int] = None, ttl: Optional[float] = None) -> int:
+        """Write `value` and return the new version.
+
+        With `expected_version` set, the write only succeeds if the stored
+        version still matches (0 = key must not exist), else VersionConflict.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_if_equal(self, key: str, value: Any) -> bool:
+        """Delete `key` only if it currently holds `value`; return whether it did."""
+        raise NotImplementedError
+
+
+class SQLiteStateStore(StateStore):
+    """Default backend: a single SQLite file.
+
+    WAL mode relies on shared memory, so replicas must run on the same host;
+    use RedisStateStore when they are spread over several machines.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " version INTEGER NOT NULL,"
+                " expires_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS state_expires_at ON state (expires_at)")
+            conn.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per call: Streamlit reruns scripts on several threads
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def get(self, key: str) -> Tuple[Optional[Any], int]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT value, version FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, time.time()),
+            ).fetchone()
+        if row is None:
+            return None, 0
+        return json.loads(row[0]), int(row[1])
+
+    def get_version(self, key: str) -> int:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT version FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, time.time()),
+            ).fetchone()
+        return int(row[0]) if row is not None else 0
+
+    def put(self, key: str, value: Any, expected_version: Optional[int] = None, ttl: Optional[float] = None) -> int:
+        payload = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with closing(self._connect()) as conn:
+            # BEGIN IMMEDIATE takes the write lock so read-compare-write is atomic
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Sweep expired rows (OCR cache entries, stale locks) while holding the lock
+                conn.execute("DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+                row = conn.execute("SELECT version, expires_at FROM state WHERE key = ?", (key,)).fetchone()
+                current = 0
+                if row is not None and (row[1] is None or row[1] > now):
+                    current = int(row[0])
+                if expected_version is not None and current != expected_version:
+                    raise VersionConflict(key, expected_version, current)
+                conn.execute(
+                    "INSERT OR REPLACE INTO state (key, value, version, expires_at) VALUES (?, ?, ?, ?)",
+                    (key, payload, current + 1, expires_at),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return current + 1
+
+    def delete(self, key: str) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def delete_if_equal(self, key: str, value: Any) -> bool:
+        payload = json.dumps(value, ensure_ascii=False)
+        with closing(self._connect()) as conn:
+            cur = conn.execute(
+                "DELETE FROM state WHERE key = ? AND value = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, payload, time.time()),
+            )
+        return cur.rowcount > 0
+
+
+class RedisStateStore(StateStore):
+    """Redis backend for several replicas. Accepts any redis-py compatible client
+    (e.g. `fakeredis.FakeRedis()` for local tests)."""
+
+    def __init__(self, client=None, url: Optional[str] = None, prefix: str = "fiche:"):
+        if client is None:
+            client = redis.Redis.from_url(url or "redis://localhost:6379/0")
+        self.client = client
+        self.prefix = prefix
+
+    def _k(self, key: str) -> str:
+        return self.prefix + key
+
+    def get(self, key: str) -> Tuple[Optional[Any], int]:
+        raw = self.client.hmget(self._k(key), "value", "version")
+        if raw[0] is None:
+            return None, 0
+        return json.loads(raw[0]), int(raw[1])
+
+    def get_version(self, key: str) -> int:
+        return int(self.client.hget(self._k(key), "version") or 0)
+
+    def put(self, key: str, value: Any, expected_version: Optional[int] = None, ttl: Optional[float] = None) -> int:
+        k = self._k(key)
+        payload = json.dumps(value, ensure_ascii=False)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(k)
+                    current = int(pipe.hget(k, "version") or 0)
+                    if expected_version is not None and current != expected_version:
+                        pipe.unwatch()
+                        raise VersionConflict(key, expected_version, current)
+                    pipe.multi()
+                    pipe.hset(k, mapping={"value": payload, "version": current + 1})
+                    if ttl:
+                        pipe.pexpire(k, int(ttl * 1000))
+                    else:
+                        pipe.persist(k)
+                    pipe.execute()
+                    return current + 1
+                except WatchError:
+                    # Someone wrote in between: a conditional write has lost, a blind one retries
+                    if expected_version is not None:
+                        _, current = self.get(key)
+                        raise VersionConflict(key, expected_version, current)
+                    continue
+
+    def delete(self, key: str) -> None:
+        self.client.delete(self._k(key))
+
+    def delete_if_equal(self, key: str, value: Any) -> bool:
+        k = self._k(key)
+        payload = json.dumps(value, ensure_ascii=False)
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(k)
+                current = pipe.hget(k, "value")
+                if isinstance(current, bytes):
+                    current = current.decode("utf-8")
+                if current != payload:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.delete(k)
+                pipe.execute()
+                return True
+            except WatchError:
+                # The key changed under us, so it is no longer ours to delete
+                return False
+
+
+# Singleton-style accessor, configured from the environment
+_store: Optional[StateStore] = None
+
+
+def _get_default_db_path() -> str:
+    state_dir = os.environ.get("STATE_DIR")
+    if state_dir:
+        # An explicit directory is expected to be a mounted volume: never fall
+        # back silently, or this replica would drift on a private database
+        base = Path(state_dir)
+        if not base.is_dir():
+            raise FileNotFoundError(f"STATE_DIR={state_dir} does not exist (volume not mounted?)")
+        return str(base / "state.sqlite3")
+    # Prefer /app/data in container; fallback to ./data locally
+    base = Path("/app/data")
+    if not base.exists():
+        base = Path("./data")
+        base.mkdir(parents=True, exist_ok=True)
+    return str(base / "state.sqlite3")
+
+
+def get_store() -> StateStore:
+    global _store
+    if _store is None:
+        backend = os.environ.get("STATE_BACKEND", "redis" if os.environ.get("REDIS_URL") else "sqlite").lower()
+        if backend == "redis":
+            _store = RedisStateStore(url=os.environ.get("REDIS_URL"))
+        else:
+            _store = SQLiteStateStore(os.environ.get("STATE_DB", _get_default_db_path()))
+        logger.info(f"STATE: using {type(_store).__name__} backend")
+    return _store
+
+
+def set_store(store: Optional[StateStore]) -> None:
+    global _store
+    _store = store
+
+
+def _namespaced(name: str) -> str:
+    return f"{os.environ.get('STATE_NAMESPACE', 'default')}:{name}"
+
+
+# Shared documents (lexicon, reservation drafts)
+
+def load_document(store: StateStore, name: str, default: Any) -> Tuple[Any, int]:
+    value, version = store.get(_namespaced(name))
+    if version == 0:
+        return default, 0
+    return value, version
+
+
+def document_version(store: StateStore, name: str) -> int:
+    return store.get_version(_namespaced(name))
+
+
+def save_document(store: StateStore, name: str, value: Any, expected_version: int) -> int:
+    version = store.put(_namespaced(name), value, expected_version=expected_version)
+    logger.info(f"STATE: saved '{name}' at version {version}")
+    return version
+
+
+# OCR cache: results keyed by image hash so any replica can reuse them
+
+OCR_CACHE_TTL = float(os.environ.get("OCR_CACHE_TTL", 7 * 24 * 3600))
+OCR_LOCK_TTL = float(os.environ.get("OCR_LOCK_TTL", 120))
+
+
+def ocr_cache_key(image_bytes: bytes) -> str:
+    return "ocr:" + hashlib.sha256(image_bytes).hexdigest()
+
+
+def cached_ocr(store: StateStore, image_bytes: bytes,
+               compute: Callable[[bytes], Tuple[str, List[str]]],
+               wait_seconds: float = OCR_LOCK_TTL, poll: float = 0.5) -> Tuple[str, List[str]]:
+    """Return OCR results for `image_bytes`, computing them at most once across replicas.
+
+    The replica that claims the image runs `compute`; the others wait for its
+    result, take the claim over if it is released without one (failed OCR),
+    and compute it themselves after `wait_seconds`.
+    """
+    key = ocr_cache_key(image_bytes)
+    result_key = _namespaced(key)
+    lock_key = _namespaced(key + ":lock")
+    token = uuid.uuid4().hex
+
+    def _claim() -> bool:
+        try:
+            store.put(lock_key, token, expected_version=0, ttl=OCR_LOCK_TTL)
+            return True
+        except VersionConflict:
+            return False
+
+    def _compute_and_store() -> Tuple[str, List[str]]:
+        text, notes = compute(image_bytes)
+        store.put(result_key, [text, list(notes)], ttl=OCR_CACHE_TTL)
+        return text, notes
+
+    hit, _ = store.get(result_key)
+    if hit is not None:
+        logger.debug(f"STATE: OCR cache hit for {key}")
+        return hit[0], hit[1]
+    claimed = _claim()
+    if not claimed:
+        logger.info(f"STATE: OCR for {key} is running on another replica, waiting")
+        deadline = time.time() + wait_seconds
+        while time.time() < deadline:
+            time.sleep(poll)
+            hit, _ = store.get(result_key)
+            if hit is not None:
+                return hit[0], hit[1]
+            # Claim released without a result: the owner failed, take over
+            if store.get_version(lock_key) == 0 and _claim():
+                logger.info(f"STATE: OCR claim for {key} released without result, taking over")
+                claimed = True
+                break
+        if not claimed:
+            logger.warning(f"STATE: gave up waiting for OCR of {key}, computing locally")
+            return _compute_and_store()
+        # The owner may have stored its result just before releasing the claim
+        hit, _ = store.get(result_key)
+        if hit is not None:
+            store.delete_if_equal(lock_key, token)
+            return hit[0], hit[1]
+    try:
+        return _compute_and_store()
+    finally:
+        # Only release our own claim: if it expired, another replica may hold it now
+        store.delete_if_equal(lock_key, token)
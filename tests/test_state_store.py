@@ -0,0 +1,143 @@
+import threading
+import time
+from contextlib import closing
+
+import pytest
+
+from fiche_cuisine_app import state_store
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return state_store.SQLiteStateStore(str(tmp_path / "state.sqlite3"))
+    fakeredis = pytest.importorskip("fakeredis")
+    return state_store.RedisStateStore(client=fakeredis.FakeRedis())
+
+
+def test_put_bumps_version(store):
+    assert store.get("k") == (None, 0)
+    assert store.put("k", {"a": [1]}, expected_version=0) == 1
+    assert store.put("k", {"a": [1, 2]}, expected_version=1) == 2
+    assert store.get("k") == ({"a": [1, 2]}, 2)
+
+
+def test_stale_expected_version_raises(store):
+    store.put("k", "first", expected_version=0)
+    store.put("k", "second", expected_version=1)
+    with pytest.raises(state_store.VersionConflict) as exc:
+        store.put("k", "stale", expected_version=1)
+    assert exc.value.current == 2
+    assert store.get("k") == ("second", 2)
+
+
+def test_ttl_expiry(store):
+    store.put("k", "short", ttl=0.05)
+    assert store.get("k") == ("short", 1)
+    time.sleep(0.15)
+    assert store.get("k") == (None, 0)
+    # An expired key counts as absent for conditional writes
+    assert store.put("k", "again", expected_version=0) == 1
+
+
+def test_sqlite_sweeps_expired_rows(tmp_path):
+    store = state_store.SQLiteStateStore(str(tmp_path / "state.sqlite3"))
+    store.put("old", "x", ttl=0.05)
+    time.sleep(0.15)
+    store.put("new", "y")
+    with closing(store._connect()) as conn:
+        keys = [r[0] for r in conn.execute("SELECT key FROM state")]
+    assert keys == ["new"]
+
+
+def test_lock_released_only_by_owner(store):
+    store.put("lock", "token-a", expected_version=0, ttl=0.05)
+    time.sleep(0.15)
+    # A's claim expired and B took over
+    store.put("lock", "token-b", expected_version=0, ttl=10)
+    assert store.delete_if_equal("lock", "token-a") is False
+    assert store.get("lock") == ("token-b", 1)
+    assert store.delete_if_equal("lock", "token-b") is True
+    assert store.get("lock") == (None, 0)
+
+
+def test_cached_ocr_computes_once_across_threads(store):
+    calls = []
+
+    def compute(image_bytes):
+        calls.append(image_bytes)
+        time.sleep(0.2)
+        return "texte", ["2x pizza"]
+
+    results = []
+
+    def worker():
+        results.append(state_store.cached_ocr(store, b"capture", compute, wait_seconds=5, poll=0.01))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [("texte", ["2x pizza"])] * 4
+
+
+def test_get_version_reads_version_only(store):
+    assert store.get_version("k") == 0
+    store.put("k", {"big": list(range(100))})
+    store.put("k", {"big": []})
+    assert store.get_version("k") == 2
+
+
+def test_cached_ocr_takes_over_when_owner_fails(store):
+    owner_started = threading.Event()
+
+    def failing(image_bytes):
+        owner_started.set()
+        time.sleep(0.2)
+        raise RuntimeError("unreadable capture")
+
+    errors = []
+
+    def owner():
+        try:
+            state_store.cached_ocr(store, b"capture", failing)
+        except RuntimeError as e:
+            errors.append(e)
+
+    t = threading.Thread(target=owner)
+    t.start()
+    owner_started.wait()
+    start = time.time()
+    result = state_store.cached_ocr(store, b"capture", lambda b: ("texte", ["soupe"]),
+                                    wait_seconds=3, poll=0.01)
+    t.join()
+
+    assert result == ("texte", ["soupe"])
+    assert len(errors) == 1
+    # Took over as soon as the claim was released, not after the timeout
+    assert time.time() - start < 1.5
+    assert store.get(state_store._namespaced(state_store.ocr_cache_key(b"capture")))[0] == ["texte", ["soupe"]]
+
+
+def test_cached_ocr_stores_result_after_wait_timeout(store):
+    lock_key = state_store._namespaced(state_store.ocr_cache_key(b"capture") + ":lock")
+    store.put(lock_key, "other-replica", expected_version=0, ttl=10)
+    calls = []
+
+    def compute(image_bytes):
+        calls.append(image_bytes)
+        return "texte", ["dessert"]
+
+    assert state_store.cached_ocr(store, b"capture", compute, wait_seconds=0.1, poll=0.01) == ("texte", ["dessert"])
+    # Later uploads hit the cache instead of waiting and recomputing
+    assert state_store.cached_ocr(store, b"capture", compute, wait_seconds=0.1, poll=0.01) == ("texte", ["dessert"])
+    assert len(calls) == 1
+
+
+def test_missing_state_dir_fails_loudly(tmp_path, monkeypatch):
+    monkeypatch.setenv("STATE_DIR", str(tmp_path / "not-mounted"))
+    with pytest.raises(FileNotFoundError):
+        state_store._get_default_db_path()